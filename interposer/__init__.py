@@ -16,6 +16,25 @@ from typing import Union
 
 from wrapt import CallableObjectProxy
 
+# types that are never wrapped when loaded as an attribute
+_PRIMITIVES = frozenset(
+    {
+        type(None),
+        bool,
+        bytearray,
+        bytes,
+        complex,
+        dict,
+        float,
+        frozenset,
+        int,
+        list,
+        set,
+        str,
+        tuple,
+    }
+)
+
 
 @dataclass
 class CallBypass:
@@ -179,6 +198,8 @@ class Interposer(CallableObjectProxy):
         """
         super().__init__(entity)
         self._self_handlers = handlers if isinstance(handlers, list) else [handlers]
+        # attribute name to (attribute, interposer) for wrapped attributes
+        self._self_wrapped: Dict[str, Tuple[Any, Any]] = dict()
 
     def __call__(self, *args, **kwargs):
         """
@@ -236,17 +257,43 @@ class Interposer(CallableObjectProxy):
         we want to wrap until we get to a __call__.  This allows top level
         objects that construct helpers as attributes (@property) to be
         captured properly.
+
+        Wrapped attributes are cached and reused as long as a lookup yields
+        the same attribute (or a method bound to the same thing).
         """
         attr = super().__getattr__(name)
+        if type(attr) in _PRIMITIVES:
+            return attr
+        cached = self._self_wrapped.get(name)
+        if cached is not None and _isalias(cached[0], attr):
+            return cached[1]
         wrap = inspect.isbuiltin(attr) or inspect.getmodule(attr)
         if wrap:
             # FIXME: derived types cannot have additional arguments
-            attr = type(self)(attr, self._self_handlers)
+            wrapped = type(self)(attr, self._self_handlers)
+            self._self_wrapped[name] = (attr, wrapped)
+            attr = wrapped
         return attr
 
 
+def _isalias(this: Any, that: Any) -> bool:
+    """
+    Checks if two attribute lookups yielded the same thing.
+
+    Each lookup of a method creates a new bound method object, so those
+    are the same if they bind the same function to the same object.
+    """
+    if this is that:
+        return True
+    if inspect.ismethod(this) and inspect.ismethod(that):
+        return this.__func__ is that.__func__ and this.__self__ is that.__self__
+    if inspect.isbuiltin(this) and inspect.isbuiltin(that):
+        return this.__self__ is that.__self__ and this.__name__ == that.__name__
+    return False
+
+
 def isinterposed(entity: Any) -> bool:
     """
     Checks to see if something is being interposed.
     """
-    return type(entity) == Interposer
+    return type(entity) is Interposer
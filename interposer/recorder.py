@@ -5,7 +5,11 @@
 #
 import gzip
 import inspect
+import io
 import os
+import shutil
+import sys
+import tempfile
 from contextlib import ExitStack
 from pathlib import Path
 from typing import Any
@@ -27,6 +31,13 @@ from interposer import Interposer
 from interposer.tapedeck import Mode
 from interposer.tapedeck import TapeDeck
 
+try:
+    # ISA-L decompresses much faster than zlib, if installed; its
+    # compression levels differ so it is only used to read recordings
+    from isal import igzip as gunzip  # pragma: no cover
+except ImportError:
+    gunzip = gzip
+
 
 class RecordedTestCase(TestCase):
     """
@@ -51,9 +62,24 @@ class RecordedTestCase(TestCase):
     # the name of the directory created alongside the test script
     TAPE_DIRECTORY_NAME: str = "tapes"
 
+    # the chunk size used when (de)compressing recordings
+    COPY_BUFFER_SIZE: int = 128 * 1024
+
+    # gzip level for new recordings; 9 is much slower for little gain
+    COMPRESS_LEVEL: int = 6
+
+    # recordings up to this uncompressed size are (de)compressed in one shot
+    ONE_SHOT_LIMIT: int = 1024 * 1024
+
     # the tape deck
     tapedeck: ClassVar[TapeDeck] = NotImplemented
 
+    # the compressed recording
+    _compressed: ClassVar[Path] = NotImplemented
+
+    # where a recording is decompressed for playback
+    _scratch: ClassVar[Optional[Path]] = None
+
     @classmethod
     def setUpClass(cls) -> None:
         """
@@ -73,18 +99,36 @@ class RecordedTestCase(TestCase):
         recordings = Path(module.__file__).parent / cls.TAPE_DIRECTORY_NAME / testname
 
         recording = recordings / f"{cls.__name__}.db"
+        compressed = cls._compressed = Path(str(recording) + ".gz")
         if mode == Mode.Playback:
-            # decompress the recording
-            with gzip.open(str(recording) + ".gz", "rb") as fin:
-                with recording.open("wb") as fout:
-                    fout.write(fin.read())
+            # raises if there is no recording, before anything is created
+            inflated = cls._inflated_size(compressed)
+            # decompress the recording into memory-backed storage if possible
+            shm = Path("/dev/shm")  # nosec
+            cls._scratch = Path(tempfile.mkdtemp(dir=shm if shm.is_dir() else None))
+            recording = cls._scratch / recording.name
+            try:
+                if inflated <= cls.ONE_SHOT_LIMIT:
+                    recording.write_bytes(gunzip.decompress(compressed.read_bytes()))
+                else:
+                    # the decoder does its own buffering, so read the file unbuffered
+                    with compressed.open("rb", buffering=0) as raw:
+                        with gunzip.open(raw, "rb") as fin:
+                            with recording.open("wb") as fout:
+                                cls._copy(fin, fout)
+                cls.tapedeck = TapeDeck(recording, mode)
+                cls.tapedeck.open()
+            except Exception:
+                # tearDownClass is not called when setUpClass fails
+                shutil.rmtree(cls._scratch)
+                cls._scratch = None
+                raise
         else:
             recordings.mkdir(parents=True, exist_ok=True)
             if recording.exists():
                 recording.unlink()
-
-        cls.tapedeck = TapeDeck(recording, mode)
-        cls.tapedeck.open()
+            cls.tapedeck = TapeDeck(recording, mode)
+            cls.tapedeck.open()
 
     @classmethod
     def tearDownClass(cls) -> None:
@@ -96,15 +140,52 @@ class RecordedTestCase(TestCase):
         cls.tapedeck.close()
         if mode == Mode.Recording:
             # compress the recording
-            with recording.open("rb") as fin:
-                with gzip.open(str(recording) + ".gz", "wb") as fout:
-                    fout.write(fin.read())
+            if recording.stat().st_size <= cls.ONE_SHOT_LIMIT:
+                cls._compressed.write_bytes(
+                    gzip.compress(recording.read_bytes(), cls.COMPRESS_LEVEL)
+                )
+            else:
+                with recording.open("rb") as fin:
+                    with gzip.open(
+                        cls._compressed, "wb", compresslevel=cls.COMPRESS_LEVEL
+                    ) as fout:
+                        cls._copy(fin, fout)
 
         # recording is the uncompressed file - do not leave it around
-        recording.unlink()
+        if cls._scratch is not None:
+            shutil.rmtree(cls._scratch)
+            cls._scratch = None
+        else:
+            recording.unlink()
 
         super().tearDownClass()
 
+    @staticmethod
+    def _inflated_size(compressed: Path) -> int:
+        """
+        The uncompressed size of a recording.
+
+        The gzip trailer holds the size modulo 2**32, which is wrong for
+        enormous recordings, so the compressed size is a lower bound.
+        """
+        with compressed.open("rb") as fin:
+            fin.seek(-4, io.SEEK_END)
+            size = int.from_bytes(fin.read(4), "little")
+        return max(size, compressed.stat().st_size)
+
+    @classmethod
+    def _copy(cls, fin: io.BufferedIOBase, fout: io.BufferedIOBase) -> None:
+        """
+        Copy one file to another through a single reused buffer.
+        """
+        buffer = bytearray(cls.COPY_BUFFER_SIZE)
+        view = memoryview(buffer)
+        while True:
+            size = fin.readinto(buffer)
+            if not size:
+                break
+            fout.write(view[:size])
+
     def redact(self, secret: Union[str, bytes], identifier: str) -> Union[str, bytes]:
         """
         In recording mode, pass in the secret and a unique identifier that
@@ -138,7 +219,8 @@ class TapeDeckCallHandler(CallHandler):
             channel (str): the channel name
         """
         super().__init__()
-        self._self_channel = channel
+        # interned since it keys the ordinals for every call on the channel
+        self._self_channel = sys.intern(channel)
         self._self_deck = deck
 
     @staticmethod
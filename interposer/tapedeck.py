@@ -3,23 +3,31 @@
 # Copyright (C) 2019 - 2021 Tuono, Inc.
 # Copyright (C) 2021 - 2022 CloudTruth, Inc.
 #
+import dbm
 import difflib
 import io
 import logging
 import pickle  # nosec
 import pickletools  # nosec
+import re
 import shelve  # nosec
+import zlib
 from contextlib import AbstractContextManager
 from dataclasses import dataclass
 from enum import auto
 from enum import Enum
+from hashlib import blake2b
 from hashlib import sha256
 from pathlib import Path
 from typing import Any
 from typing import Callable
 from typing import cast
 from typing import Dict
+from typing import List
+from typing import MutableMapping
 from typing import Optional
+from typing import Pattern
+from typing import Tuple
 from typing import Union
 
 import yaml
@@ -43,6 +51,10 @@ class Mode(Enum):
 class Payload:
     """
     The record for the content behind each hash.
+
+    Starting with file format 8 only the result and exception are stored
+    behind each hash; the context is stored separately and a Payload is
+    only assembled when dumping a recording.
     """
 
     context: CallContext
@@ -139,16 +151,37 @@ class TapeDeck(AbstractContextManager):
       -  5: support datetime and enum in argument lists
       -  6: major refactor rendered previous recordings unusable
       -  7: added original secret length redaction mapping
+      -  8: payloads hold only the result and exception, stored as
+            pickles that are zlib compressed when large; payloads and
+            call pickles are stored as raw bytes outside of the shelf;
+            calls are keyed by a 128-bit blake2b digest instead of sha256
 
     NOTE: We are expressly not using `dill` because it stores class
           definitions and as a result would not actually catch errors
           when a third party library is updated.
     """
 
-    CURRENT_FILE_FORMAT = 7
+    CURRENT_FILE_FORMAT = 8
     EARLIEST_FILE_FORMAT_SUPPORTED = 7
+
+    # call hashes are computed over pickles so changing the protocol
+    # invalidates existing recordings; protocol 5 out-of-band buffers
+    # are also unsuitable because they would bypass secret redaction,
+    # which operates on the pickle byte stream
     PICKLE_PROTOCOL = 4
 
+    # pickled payloads larger than this (in bytes) get compressed
+    COMPRESS_THRESHOLD = 512
+    COMPRESS_LEVEL = 3
+
+    # entries stored while recording are written out once they exceed
+    # this many bytes, bounding memory use on long recordings
+    PENDING_LIMIT = 16 * 1024 * 1024
+
+    # the first byte of a stored result identifies the encoding
+    ENCODING_RAW = b"R"
+    ENCODING_ZLIB = b"Z"
+
     LABEL_CHANNEL = "channel"
     LABEL_HASH = "hash"
     LABEL_ORDINAL = "ordinal"
@@ -158,6 +191,12 @@ class TapeDeck(AbstractContextManager):
     LABEL_FILE_FORMAT = "_file_format"
     LABEL_VERSION = "_version"  # extant; use LABEL_FILE_FORMAT
 
+    # how keys are encoded in the database, the same as shelve uses
+    KEY_ENCODING = "utf-8"
+
+    # memory addresses in a repr, replaced so calls hash the same across runs
+    ADDRESS_PATTERN = re.compile(r"(?<= at 0x)[^\W_]*")
+
     # a logging level lower than logging.DEBUG (10)
     DEBUG_WITH_RESULTS = 7
 
@@ -177,8 +216,15 @@ class TapeDeck(AbstractContextManager):
         self._call_ordinals: Dict[str, int] = {}
         self._logger = logging.getLogger(__name__)
         self._redactions: Dict[Union[str, bytes], str] = dict()
+        # the redactions compiled for _redact, rebuilt when they change
+        self._redactor: Optional[Tuple[Pattern[bytes], Dict[bytes, bytes]]] = None
         # the open file resource
         self._tape: shelve.Shelf[object] = NotImplemented
+        # the database underneath the shelf, for values that are already bytes
+        self._db: MutableMapping[bytes, bytes] = NotImplemented
+        # entries stored while recording that are not yet in the database
+        self._pending: Dict[bytes, bytes] = dict()
+        self._pending_size = 0
 
     def __enter__(self):
         """AbstractContextManager"""
@@ -189,6 +235,34 @@ class TapeDeck(AbstractContextManager):
         """AbstractContextManager"""
         self.close()
 
+    def compact(self) -> None:
+        """
+        Shrink the stored results of a recording.
+
+        Each stored result is rewritten through pickletools.optimize which
+        drops unused memo opcodes.  That costs more than pickling itself so
+        it is never done while recording calls; call this once before close
+        to make the recording smaller and quicker to play back.  The stored
+        call contexts are left alone as their hashes locate the results.
+
+        In playback mode the recording is read-only and this does nothing.
+
+        Raises:
+            TapeDeckOpenError if the tape deck is not open.
+        """
+        if self._tape == NotImplemented:
+            raise TapeDeckOpenError()
+
+        if self.mode != Mode.Recording:
+            return
+
+        self._flush()
+        for key in list(self._tape.keys()):
+            if key[0] != "_":
+                raw = self._unpack_raw(cast(bytes, self._load(key)))
+                self._store(key, self._pack(pickletools.optimize(raw)))
+        self._flush()
+
     def dump(self, outfile: Path) -> None:
         """
         Dump the database file for analysis.
@@ -203,26 +277,34 @@ class TapeDeck(AbstractContextManager):
             TapeDeckOpenError if the tape deck is not open.
         """
         results: Dict[str, Any] = {}
+        # ordinals are dense within a channel so they index the call list
+        channels: Dict[str, List[Optional[Payload]]] = {}
 
         if self._tape == NotImplemented:
             raise TapeDeckOpenError()
 
+        self._flush()
         for key in self._tape.keys():
-            payload = self._tape[key]
-            if key[0] == "_":
-                results[key] = payload
-            else:
-                channel = payload.context.meta["tape"]["channel"]  # type: ignore
-                results.setdefault(channel, []).append(payload)
-
-        for channel in results.keys():
-            if channel[0] != "_":
-                results[channel] = list(
-                    sorted(
-                        results[channel],
-                        key=lambda item: item.context.meta["tape"]["ordinal"],
-                    )
-                )
+            if key.startswith("_call_"):
+                # the hash of the recorded call locates its result
+                raw = cast(bytes, self._load(key))
+                stored = self._load(self._digest(raw))
+                if stored is None:
+                    # the result could not be pickled so it was never recorded
+                    continue
+                context = cast(CallContext, pickle.loads(raw))  # nosec
+                result, ex = self._unpack(stored)
+                our_meta = context.meta[self.LABEL_TAPE]
+                calls = channels.setdefault(our_meta[self.LABEL_CHANNEL], [])
+                ordinal = our_meta[self.LABEL_ORDINAL]
+                if ordinal >= len(calls):
+                    calls.extend([None] * (ordinal + 1 - len(calls)))
+                calls[ordinal] = Payload(context=context, result=result, ex=ex)
+            elif key[0] == "_":
+                results[key] = self._tape[key]
+
+        for channel, calls in channels.items():
+            results[channel] = [call for call in calls if call is not None]
         with outfile.open("w") as fout:
             yaml.dump(results, fout, Dumper=Dumper)
 
@@ -240,9 +322,8 @@ class TapeDeck(AbstractContextManager):
         self._reset()
 
         if self.mode == Mode.Playback:
-            self._tape = shelve.open(  # nosec
-                str(self.deck), flag="r", protocol=self.PICKLE_PROTOCOL
-            )
+            self._db = cast(MutableMapping[bytes, bytes], dbm.open(str(self.deck), "r"))
+            self._tape = shelve.Shelf(self._db, protocol=self.PICKLE_PROTOCOL)  # nosec
             self.file_format = cast(
                 int,
                 self._tape.get(
@@ -256,9 +337,8 @@ class TapeDeck(AbstractContextManager):
                     self.CURRENT_FILE_FORMAT,
                 )
         else:
-            self._tape = shelve.open(  # nosec
-                str(self.deck), flag="c", protocol=self.PICKLE_PROTOCOL
-            )
+            self._db = cast(MutableMapping[bytes, bytes], dbm.open(str(self.deck), "c"))
+            self._tape = shelve.Shelf(self._db, protocol=self.PICKLE_PROTOCOL)  # nosec
             self._tape[self.LABEL_FILE_FORMAT] = self.CURRENT_FILE_FORMAT
             self.file_format = self.CURRENT_FILE_FORMAT
 
@@ -276,8 +356,10 @@ class TapeDeck(AbstractContextManager):
         If the tape deck is not open, this does nothing.
         """
         if self._tape != NotImplemented:  # prevents errors closing after failed open()
+            self._flush()
             self._tape.close()
             self._tape = NotImplemented
+            self._db = NotImplemented
             self._log(
                 logging.DEBUG,
                 "close",
@@ -308,20 +390,15 @@ class TapeDeck(AbstractContextManager):
         """
         uniq = self._advance(context, channel)
 
-        payload = Payload(context=context, result=result, ex=ex)
-        try:
-            self._tape[uniq] = self._redact(payload)
-        except (pickle.PicklingError, TypeError):
-            save_call = self._reduce_call(context)
-            try:
-                self._tape[uniq] = self._redact(payload)
-            finally:
-                context.call = save_call
+        # the context itself was stored by _advance
+        raw = self._redact((result, ex), return_bytes=True)
+        self._store(uniq, self._pack(raw))
 
-        if ex is None:
-            self._log_result("record", context, result)
-        else:
-            self._log_ex("record", context, ex)
+        if self._logger.isEnabledFor(logging.DEBUG):
+            if ex is None:
+                self._log_result("record", context, result)
+            else:
+                self._log_ex("record", context, ex)
 
     def playback(self, context: CallContext, channel: str = "default") -> Any:
         """
@@ -339,19 +416,22 @@ class TapeDeck(AbstractContextManager):
             If an exception was recorded for this call, it is raised.
         """
         uniq = self._advance(context, channel)
-        recorded: Payload = cast(Payload, self._tape.get(uniq, NotImplemented))
-        if recorded is NotImplemented:
+        recorded = self._load(uniq)
+        if recorded is None:
             self._forensics(context, channel)
             raise RecordedCallNotFoundError(context)
 
-        payload = recorded
+        result, ex = self._unpack(recorded)
 
-        if payload.ex is None:
-            self._log_result("playback", context, payload.result)
-            return payload.result
+        debug = self._logger.isEnabledFor(logging.DEBUG)
+        if ex is None:
+            if debug:
+                self._log_result("playback", context, result)
+            return result
         else:
-            self._log_ex("playback", context, payload.ex)
-            raise payload.ex
+            if debug:
+                self._log_ex("playback", context, ex)
+            raise ex
 
     def redact(self, secret: Union[str, bytes], identifier: str) -> Union[str, bytes]:
         """
@@ -389,7 +469,7 @@ class TapeDeck(AbstractContextManager):
 
         if self.mode == Mode.Recording:
             secretlen = len(secret)
-            redacted = (identifier + ("_" * secretlen))[:secretlen]
+            redacted = self._redaction(identifier, secretlen)
             if self._redactions.get(secret) == redacted:
                 # calling it more than once for the same secret and ID is ok
                 return secret
@@ -399,6 +479,7 @@ class TapeDeck(AbstractContextManager):
                     f"{identifier} has already been used to redact another secret"
                 )
             self._redactions[secret] = redacted
+            self._redactor = None
             self._tape[key] = secretlen
             return secret
         else:
@@ -407,11 +488,23 @@ class TapeDeck(AbstractContextManager):
                 raise AttributeError(
                     f"{identifier} was not used during recording to redact this secret"
                 )
-            result = (identifier + ("_" * secretlen))[:secretlen]
+            result = self._redaction(identifier, secretlen)
             if isinstance(secret, bytes):
                 return result.encode()
             return result
 
+    def switch_mode(self, mode: Mode) -> None:
+        """
+        Close the tape deck and reopen it in another mode.
+
+        Pending entries are written out by the close.  This is handy for
+        tests that record calls and then play them back from the same
+        recording.
+        """
+        self.close()
+        self.mode = mode
+        self.open()
+
     def _advance(self, context: CallContext, channel: str) -> str:
         """
         Advance to processing the next call.
@@ -421,7 +514,7 @@ class TapeDeck(AbstractContextManager):
         unique signature that can be used to find the call again later.
         """
         ordinal = self._call_ordinals[channel] = (
-            self._call_ordinals.setdefault(channel, -1) + 1
+            self._call_ordinals.get(channel, -1) + 1
         )
         our_meta = context.meta.setdefault(self.LABEL_TAPE, {})
         our_meta[self.LABEL_CHANNEL] = channel
@@ -441,6 +534,14 @@ class TapeDeck(AbstractContextManager):
         our_meta[self.LABEL_HASH] = result
         return result
 
+    def _digest(self, raw: bytes) -> str:
+        """
+        Hash a redacted, pickled call context into the key for its result.
+        """
+        if self.file_format < 8:
+            return sha256(raw).hexdigest()
+        return blake2b(raw, digest_size=16).hexdigest()
+
     def _forensics(self, context: CallContext, channel: str) -> None:
         """
         Perform forensic analysis of RecordedCallNotFoundError and log:
@@ -451,7 +552,7 @@ class TapeDeck(AbstractContextManager):
         """
         ordinal = self._call_ordinals[channel]
 
-        recorded_raw = cast(bytes, self._tape.get(f"_call_{channel}_{ordinal}"))
+        recorded_raw = cast(bytes, self._load(f"_call_{channel}_{ordinal}"))
         playback_call = self._reduce_call(context)
         try:
             playback_raw = self._redact(context, return_bytes=True)
@@ -514,15 +615,39 @@ class TapeDeck(AbstractContextManager):
             our_meta = context.meta[self.LABEL_TAPE]
             channel = our_meta[self.LABEL_CHANNEL]
             ordinal = our_meta[self.LABEL_ORDINAL]
-            self._tape[f"_call_{channel}_{ordinal}"] = raw
-        uniq = sha256(raw)
-        result = uniq.hexdigest()
-        return result
+            self._store(f"_call_{channel}_{ordinal}", raw)
+        return self._digest(raw)
+
+    def _flush(self) -> None:
+        """
+        Write entries stored while recording to the database.
+        """
+        for dbkey, value in self._pending.items():
+            self._db[dbkey] = value
+        self._pending.clear()
+        self._pending_size = 0
+
+    def _load(self, key: str) -> Optional[Any]:
+        """
+        Load a stored call pickle or payload.
+
+        Recordings prior to file format 8 stored these through the shelf.
+        """
+        if self.file_format < 8:
+            return self._tape.get(key)
+        dbkey = key.encode(self.KEY_ENCODING)
+        value = self._pending.get(dbkey)
+        return value if value is not None else self._db.get(dbkey)
 
     def _log(self, level: int, category: str, action: str, msg: str) -> None:
         """
         Common funnel for logs.
+
+        Redacting secrets from the message is skipped if it would not
+        be logged anyway.
         """
+        if not self._logger.isEnabledFor(level):
+            return
         msg = f"TAPE: {category}({action}): {msg}"
         for secret, replacement in self._redactions.items():
             if isinstance(secret, str):
@@ -535,34 +660,79 @@ class TapeDeck(AbstractContextManager):
         """
         Logs recording and playback events for exceptions.
 
-        Avoids building the log message string if the message would not be logged.
+        Callers avoid building the log message string by checking that
+        the logger is enabled for logging.DEBUG first.
         """
-        if self._logger.isEnabledFor(logging.DEBUG):
-            self._log(
-                logging.DEBUG,
-                action,
-                "exception",
-                f"{context}: {type(ex).__name__}: {ex}",
-            )
+        self._log(
+            logging.DEBUG,
+            action,
+            "exception",
+            f"{context}: {type(ex).__name__}: {ex}",
+        )
 
     def _log_result(self, action: str, context: CallContext, result: Any) -> None:
         """
         Logs recording and playback events for results.
 
-        Avoids building the log message string if the message would not be logged.
+        Callers avoid building the log message string by checking that
+        the logger is enabled for logging.DEBUG first.  The result is only
+        included at the more verbose DEBUG_WITH_RESULTS level.
         """
-        if self._logger.isEnabledFor(self.DEBUG_WITH_RESULTS):
+        with_results = self._logger.isEnabledFor(self.DEBUG_WITH_RESULTS)
+        if with_results:
             context.meta[self.LABEL_TAPE][self.LABEL_RESULT] = result
-        if self._logger.isEnabledFor(logging.DEBUG):
-            self._log(
-                logging.DEBUG,
-                action,
-                "result",
-                str(context),
-            )
-        if self._logger.isEnabledFor(self.DEBUG_WITH_RESULTS):
+        self._log(
+            logging.DEBUG,
+            action,
+            "result",
+            str(context),
+        )
+        if with_results:
             context.meta[self.LABEL_TAPE].pop(self.LABEL_RESULT)
 
+    def _pack(self, raw: bytes) -> bytes:
+        """
+        Encode a pickled payload for storage, compressing it if it is large
+        enough for compression to pay for itself.
+        """
+        if len(raw) > self.COMPRESS_THRESHOLD:
+            return self.ENCODING_ZLIB + zlib.compress(raw, self.COMPRESS_LEVEL)
+        return self.ENCODING_RAW + raw
+
+    def _store(self, key: str, value: bytes) -> None:
+        """
+        Store a call pickle or payload directly in the database, as it
+        is already bytes and does not need to be pickled again by the shelf.
+
+        Entries are held in memory and written together by _flush so that
+        recording a call does not wait on database writes.
+        """
+        self._pending[key.encode(self.KEY_ENCODING)] = value
+        self._pending_size += len(value)
+        if self._pending_size > self.PENDING_LIMIT:
+            self._flush()
+
+    def _unpack(self, stored: Any) -> Tuple[Any, Optional[Exception]]:
+        """
+        Decode a stored result and exception.
+
+        Recordings prior to file format 8 stored the whole Payload object.
+        """
+        if self.file_format < 8:
+            payload = cast(Payload, stored)
+            return payload.result, payload.ex
+        unpacked = pickle.loads(self._unpack_raw(stored))  # nosec
+        return cast(Tuple[Any, Optional[Exception]], unpacked)
+
+    def _unpack_raw(self, stored: bytes) -> bytes:
+        """
+        Decode a stored result and exception to the pickle it was packed from.
+        """
+        raw = memoryview(stored)[1:]
+        if stored[:1] == self.ENCODING_ZLIB:
+            return zlib.decompress(raw)
+        return bytes(raw)
+
     def _redact(self, entity: Any, return_bytes: bool = False) -> Any:
         """
         Redacts any known secrets in an object by converting it to pickled
@@ -576,13 +746,34 @@ class TapeDeck(AbstractContextManager):
             PicklingError if something in the context cannot be pickled.
         """
         raw = pickle.dumps(entity, protocol=self.PICKLE_PROTOCOL)
-        for secret, replacement in self._redactions.items():
-            raw = raw.replace(
-                secret.encode() if isinstance(secret, str) else secret,
-                replacement.encode(),
-            )
+        if self._redactions:
+            if self._redactor is None:
+                replacements = {
+                    secret.encode() if isinstance(secret, str) else secret: (
+                        replacement.encode()
+                    )
+                    for secret, replacement in self._redactions.items()
+                }
+                # longest first so a secret containing another wins
+                pattern = re.compile(
+                    b"|".join(
+                        re.escape(secret)
+                        for secret in sorted(replacements, key=len, reverse=True)
+                    )
+                )
+                self._redactor = (pattern, replacements)
+            pattern, replacements = self._redactor
+            raw = pattern.sub(lambda match: replacements[match.group()], raw)
         return pickle.loads(raw) if not return_bytes else raw  # nosec
 
+    @staticmethod
+    def _redaction(identifier: str, length: int) -> str:
+        """
+        The replacement for a secret of the given length, which is the
+        identifier padded out with underscores or clipped to that length.
+        """
+        return identifier[:length].ljust(length, "_")
+
     def _reduce_call(self, context: CallContext) -> Callable:
         """
         Normally we try to store the call verbatim but if pickling fails
@@ -592,18 +783,7 @@ class TapeDeck(AbstractContextManager):
             The original call so it can be replaced after recording
             using a finally block.
         """
-        sig = repr(context.call)
-        pos = 0
-        while True:
-            pos = sig.find(" at 0x", pos)
-            if pos == -1:
-                break
-            pos += 6
-            end = pos
-            while sig[end].isalnum():
-                end += 1
-            sig = sig[:pos] + "0decafcoffee" + sig[end:]
-            pos += 12
+        sig = self.ADDRESS_PATTERN.sub("0decafcoffee", repr(context.call))
         result = context.call
         context.call = sig  # type: ignore
         return result
@@ -613,3 +793,4 @@ class TapeDeck(AbstractContextManager):
         self.file_format = 0
         self._call_ordinals = dict()
         self._redactions = dict()
+        self._redactor = None
@@ -6,7 +6,7 @@
 import datetime
 import inspect
 import logging
-from dataclasses import asdict
+from dataclasses import fields
 from typing import Any
 from typing import Dict
 from typing import List
@@ -123,7 +123,10 @@ class LoggingCallHandler(CallHandler):
         self.logger = logging.getLogger(__name__)
 
     def on_call_begin(self, context: CallContext) -> Optional[CallBypass]:
-        self.logger.debug(str(asdict(context)))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(
+                "%s", {f.name: getattr(context, f.name) for f in fields(context)}
+            )
         return None
 
     def on_call_end_exception(
@@ -381,3 +384,25 @@ class InterposerTest(TestCase):
         self.assertEqual(calls[0]["name"], "datetime.utcnow")
         self.assertIsInstance(calls[0]["result"], datetime.datetime)
         self.assertIn("builtin_function_or_method", str(calls[0]["type"]))
+
+    def test_interposer_attribute_cache(self):
+        """
+        Tests that wrapped attributes are reused while they do not change.
+        """
+        auditor = AuditingCallHandler()
+        obj = SimpleClass()
+        uut = Interposer(obj, auditor)
+        meth = uut.regular_call
+        self.assertTrue(isinterposed(meth))
+        self.assertIs(uut.regular_call, meth)
+        self.assertEqual(meth("foo", 42, kwarg1="sam"), "sam")
+
+        # replacing the attribute on the wrapped object is noticed
+        obj.regular_call = standalone_function
+        self.assertIsNot(uut.regular_call, meth)
+        self.assertEqual(uut.regular_call(12345), 42)
+
+        # bound builtin methods are reused too
+        wuut = Interposer(datetime.datetime, auditor)
+        self.assertIs(wuut.utcnow, wuut.utcnow)
+        self.assertEqual(len(auditor.calls), 2)
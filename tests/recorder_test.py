@@ -3,22 +3,22 @@
 # Copyright (C) 2020 Tuono, Inc.
 # Copyright (C) 2021 - 2022 CloudTruth, Inc.
 #
-import gzip
 import os
+import tempfile
 import uuid
 from pathlib import Path
 from typing import Any
+from typing import cast
+from typing import List
 from typing import Optional
+from unittest import TestCase
 from unittest.mock import patch
 
-from noaa_sdk import noaa
-
 from interposer import CallBypass
 from interposer import CallContext
 from interposer import CallHandler
 from interposer import Interposer
 from interposer import isinterposed
-from interposer.example.weather import Weather
 from interposer.recorder import RecordedTestCase
 from interposer.recorder import TapeDeckCallHandler
 from interposer.tapedeck import Mode
@@ -39,7 +39,7 @@ class DoNotRecordCallHandler(CallHandler):
     """
 
     def on_call_end_result(self, context: CallContext, result: Any) -> Any:
-        if result == 42:
+        if type(result) is int and result == 42:
             TapeDeckCallHandler.norecord(context)
         return result
 
@@ -87,7 +87,7 @@ class TestRecordedTestCase(RecordedTestCase):
         """
         Delete the recording file since we tested both modes in one test.
         """
-        datafile = Path(str(cls.tapedeck.deck) + ".gz")
+        datafile = cls._compressed
         super().tearDownClass()
         if datafile.exists():
             datafile.unlink()
@@ -100,6 +100,8 @@ class TestRecordedTestCase(RecordedTestCase):
         This is just to prove noaa_sdk uses requests to get content.
         We need this proof in order to prove something later on.
         """
+        from interposer.example.weather import Weather
+
         mock_requests.get.side_effect = LookupError("proven!")
         uut = Weather()
         with self.assertRaises(Exception):
@@ -115,6 +117,11 @@ class TestRecordedTestCase(RecordedTestCase):
         whether a test was recording or playing back by setting the
         RECORDING environment variable.
         """
+        # noaa_sdk pulls in requests, so only import it in the tests using it
+        from noaa_sdk import noaa
+
+        from interposer.example.weather import Weather
+
         # self.tapedeck is set up by the fixture
         self.assertEqual(self.tapedeck.mode, Mode.Recording)
 
@@ -144,9 +151,7 @@ class TestRecordedTestCase(RecordedTestCase):
         RECORDING set in the environment, and then you run the test again
         without that environment variable to play it back.
         """
-        self.tapedeck.close()
-        self.tapedeck.mode = Mode.Playback
-        self.tapedeck.open()
+        self.tapedeck.switch_mode(Mode.Playback)
 
         # The noaa-sdk library uses `requests` (proven above) so while we are
         # using playback mode, let's also patch requests to prove that
@@ -169,9 +174,7 @@ class TestRecordedTestCase(RecordedTestCase):
         mock_requests.assert_not_called()
 
         # put it back into Recording mode so the fixture can clean up
-        self.tapedeck.close()
-        self.tapedeck.mode = Mode.Recording
-        self.tapedeck.open()
+        self.tapedeck.switch_mode(Mode.Recording)
 
     def test_cannot_pickle(self):
         """
@@ -240,9 +243,7 @@ class TestRecordedTestCase(RecordedTestCase):
         # is it rewrapped after recording?
         self.assertTrue(isinterposed(uut.times_two(21)))
 
-        self.tapedeck.close()
-        self.tapedeck.mode = Mode.Playback
-        self.tapedeck.open()
+        self.tapedeck.switch_mode(Mode.Playback)
 
         uut = Interposer(
             SomeClass(),
@@ -256,9 +257,7 @@ class TestRecordedTestCase(RecordedTestCase):
         self.assertTrue(isinterposed(uut.times_two(21)))
 
         # put it back into Recording mode so the fixture can clean up
-        self.tapedeck.close()
-        self.tapedeck.mode = Mode.Recording
-        self.tapedeck.open()
+        self.tapedeck.switch_mode(Mode.Recording)
 
 
 class HolderOfFineSecrets(object):
@@ -272,6 +271,9 @@ class HolderOfFineSecrets(object):
     def get_token(self) -> str:
         return self.token
 
+    def get_tokens(self, count: int) -> List[str]:
+        return [self.token] * count
+
 
 class SecretsTestCase(RecordedTestCase):
     """
@@ -293,18 +295,19 @@ class SecretsTestCase(RecordedTestCase):
         """
         Delete the recording file since we tested both modes in one test.
         """
-        datafile = Path(str(cls.tapedeck.deck) + ".gz")
-        redactions = cls.tapedeck._redactions
+        datafile = cls._compressed
+        deck = cls.tapedeck
+        # large payloads are compressed inside the recording, so look
+        # for the secret in each decoded value rather than the raw file
+        deck._flush()
+        secret = cls.token.encode()
+        for key in deck._tape.keys():
+            stored = cast(bytes, deck._load(key))
+            if key[0] != "_":
+                stored = deck._unpack_raw(stored)
+            assert secret not in stored, "a secret leaked into the recording!"  # nosec
         super().tearDownClass()
         if datafile.exists():
-            with gzip.open(datafile, "rb") as fin:
-                raw = fin.read()
-                for secret, replacement in redactions.items():
-                    assert (  # nosec
-                        isinstance(secret, bytes) and secret not in raw
-                    ) or (
-                        isinstance(secret, str) and secret.encode() not in raw
-                    ), "a secret leaked into the recording!"
             datafile.unlink()
         os.environ.pop("RECORDING")
 
@@ -333,10 +336,10 @@ class SecretsTestCase(RecordedTestCase):
         uut = cls(self.redact(self.token, "TOKEN"))
         self.assertTrue(self.tapedeck._redactions)
         self.assertEqual(uut.get_token(), self.redact(self.token, "TOKEN2"))
+        # a result large enough to be compressed in the recording
+        self.assertEqual(uut.get_tokens(64), [self.token] * 64)
 
-        self.tapedeck.close()  # applies redaction to recording
-        self.tapedeck.mode = Mode.Playback
-        self.tapedeck.open()
+        self.tapedeck.switch_mode(Mode.Playback)  # applies redaction to recording
 
         self.assertFalse(self.tapedeck._redactions)
         uut = cls(self.redact("foo", "TOKEN"))
@@ -345,10 +348,94 @@ class SecretsTestCase(RecordedTestCase):
 
         # most importantly, the object initializer argument was redacted
         self.assertEqual(uut.get_token(), foo)
+        # the secret was last registered under TOKEN2 before this was recorded
+        self.assertEqual(uut.get_tokens(64), [self.redact("foo", "TOKEN2")] * 64)
         with self.assertRaises(RecordedCallNotFoundError):
             uut.get_token()
 
         # put it back into Recording mode so the fixture can clean up
-        self.tapedeck.close()
-        self.tapedeck.mode = Mode.Recording
-        self.tapedeck.open()
+        self.tapedeck.switch_mode(Mode.Recording)
+
+
+class CorruptRecordedTestCase(RecordedTestCase):
+    """
+    Only used by PlaybackSetupTest; it has no tests of its own.
+    """
+
+
+class PlaybackSetupTest(TestCase):
+    """
+    Tests RecordedTestCase cleans up when playback cannot start.
+    """
+
+    def test_missing_recording(self):
+        with patch.dict(os.environ):
+            os.environ.pop("RECORDING", None)
+            with patch("interposer.recorder.tempfile.mkdtemp") as mkdtemp:
+                with self.assertRaises(FileNotFoundError):
+                    CorruptRecordedTestCase.setUpClass()
+        mkdtemp.assert_not_called()
+
+    def test_corrupt_recording(self):
+        recordings = Path(__file__).parent / RecordedTestCase.TAPE_DIRECTORY_NAME
+        compressed = recordings / "recorder_test" / "CorruptRecordedTestCase.db.gz"
+        compressed.parent.mkdir(parents=True, exist_ok=True)
+        compressed.write_bytes(b"this is not a recording")
+        scratch: List[str] = []
+        mkdtemp = tempfile.mkdtemp
+
+        def spy(**kwargs: Any) -> str:
+            scratch.append(mkdtemp(**kwargs))
+            return scratch[-1]
+
+        try:
+            with patch.dict(os.environ):
+                os.environ.pop("RECORDING", None)
+                with patch("interposer.recorder.tempfile.mkdtemp", new=spy):
+                    with self.assertRaises(OSError):
+                        CorruptRecordedTestCase.setUpClass()
+        finally:
+            compressed.unlink()
+        self.assertEqual(len(scratch), 1)
+        self.assertFalse(Path(scratch[0]).exists())
+        self.assertIsNone(CorruptRecordedTestCase._scratch)
+
+
+class StreamedRecordedTestCase(RecordedTestCase):
+    """
+    Only used by StreamedRecordingTest; its recordings are always streamed.
+    """
+
+    ONE_SHOT_LIMIT = 0
+    COPY_BUFFER_SIZE = 7
+
+
+class StreamedRecordingTest(TestCase):
+    """
+    Tests RecordedTestCase (de)compresses recordings in chunks.
+    """
+
+    def test_record_playback(self):
+        uut = StreamedRecordedTestCase
+        channel = self.id().split(".")[-1]
+        try:
+            with patch.dict(os.environ, {"RECORDING": "1"}):
+                uut.setUpClass()
+            self.assertEqual(uut.tapedeck.mode, Mode.Recording)
+            handler = TapeDeckCallHandler(uut.tapedeck, channel)
+            self.assertEqual(Interposer(SomeClass(), handler).times_two(21), 42)
+            uut.tearDownClass()
+            self.assertGreater(uut._compressed.stat().st_size, uut.COPY_BUFFER_SIZE)
+
+            with patch.dict(os.environ):
+                os.environ.pop("RECORDING", None)
+                uut.setUpClass()
+            self.assertEqual(uut.tapedeck.mode, Mode.Playback)
+            handler = TapeDeckCallHandler(uut.tapedeck, channel)
+            self.assertEqual(Interposer(SomeClass(), handler).times_two(21), 42)
+            with self.assertRaises(RecordedCallNotFoundError):
+                Interposer(SomeClass(), handler).times_two(21)
+            uut.tearDownClass()
+        finally:
+            if uut._compressed.exists():
+                uut._compressed.unlink()
@@ -6,14 +6,19 @@
 import logging
 import os
 import pickle  # nosec
+import secrets
 import shutil
 import tempfile
+import threading
 import uuid
 from datetime import datetime
+from enum import Enum
 from hashlib import sha256
 from pathlib import Path
 from unittest import TestCase
 
+import yaml
+
 from interposer import CallContext
 from interposer.tapedeck import Mode
 from interposer.tapedeck import RecordedCallNotFoundError
@@ -31,6 +36,11 @@ class SomeClass(object):
         return uuid.uuid4()
 
 
+class Brother(Enum):
+    DEAN = "dean"
+    SAM = "sam"
+
+
 class KeeperOfFineSecrets(object):
     """
     A typical object that holds a secret (token).
@@ -44,8 +54,21 @@ class KeeperOfFineSecrets(object):
 
 
 class TapeDeckTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # memory-backed storage keeps recording I/O off the disk if possible
+        shm = Path("/dev/shm")  # nosec
+        cls.rootdir = Path(tempfile.mkdtemp(dir=shm if shm.is_dir() else None))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(str(cls.rootdir))
+        super().tearDownClass()
+
     def setUp(self):
-        self.datadir = Path(tempfile.mkdtemp())
+        self.datadir = self.rootdir / self._testMethodName
+        self.datadir.mkdir()
         self.someclass = SomeClass("foo")
         self.context1 = CallContext(
             call=self.someclass.amethod,
@@ -61,9 +84,6 @@ class TapeDeckTest(TestCase):
             kwargs={},
         )
 
-    def tearDown(self):
-        shutil.rmtree(str(self.datadir))
-
     def test_pickle_method_idempotent(self):
         """
         This proves pickling two methods in two different objects will not
@@ -151,6 +171,59 @@ class TapeDeckTest(TestCase):
             with self.assertRaises(RecordedCallNotFoundError):
                 uut.playback(self.context1)
 
+    def test_compressed_payload(self):
+        """Tests that large payloads get compressed and play back intact."""
+        large = "sam and dean " * TapeDeck.COMPRESS_THRESHOLD
+        with TapeDeck(self.datadir / "recording", Mode.Recording) as uut:
+            uut.record(self.context1, large, None)
+            uut.record(self.context2, "small", None)
+            # write out the pending entries so the tape lists them
+            uut._flush()
+            stored = [uut._load(key) for key in uut._tape.keys() if key[0] != "_"]
+            self.assertEqual(
+                sorted(raw[:1] for raw in stored),
+                [TapeDeck.ENCODING_RAW, TapeDeck.ENCODING_ZLIB],
+            )
+            self.context1.meta.pop(TapeDeck.LABEL_TAPE)
+            self.context2.meta.pop(TapeDeck.LABEL_TAPE)
+
+        with TapeDeck(self.datadir / "recording", Mode.Playback) as uut:
+            self.assertEqual(uut.playback(self.context1), large)
+            self.assertEqual(uut.playback(self.context2), "small")
+
+    def test_pending_flush(self):
+        """Tests that stored entries are held in memory until flushed."""
+        with TapeDeck(self.datadir / "recording", Mode.Recording) as uut:
+            uut.record(self.context1, "sam", None)
+            uniq = uut._digest(uut._load("_call_default_0")).encode()
+            self.assertIn(uniq, uut._pending)
+            self.assertNotIn(uniq, uut._db)
+            uut._flush()
+            self.assertFalse(uut._pending)
+            self.assertEqual(uut._pending_size, 0)
+            self.assertIn(uniq, uut._db)
+
+    def test_pending_limit(self):
+        """Tests that stored entries are written out once they grow too large."""
+        with TapeDeck(self.datadir / "recording", Mode.Recording) as uut:
+            uut.PENDING_LIMIT = 1
+            uut.record(self.context1, "sam", None)
+            self.assertFalse(uut._pending)
+            self.assertEqual(uut._pending_size, 0)
+            self.context1.meta.pop(TapeDeck.LABEL_TAPE)
+
+        with TapeDeck(self.datadir / "recording", Mode.Playback) as uut:
+            self.assertEqual(uut.playback(self.context1), "sam")
+
+    def test_switch_mode(self):
+        """Tests switching from recording to playback on an open tape deck."""
+        with TapeDeck(self.datadir / "recording", Mode.Recording) as uut:
+            uut.record(self.context1, "castiel", None)
+            self.context1.meta.pop(TapeDeck.LABEL_TAPE)
+            uut.switch_mode(Mode.Playback)
+            self.assertEqual(uut.mode, Mode.Playback)
+            self.assertEqual(uut.playback(self.context1), "castiel")
+
     def test_open_close_twice(self):
         """Tests calling open and close twice."""
         with TapeDeck(self.datadir / "recording", Mode.Recording) as uut:
@@ -158,6 +231,73 @@ class TapeDeckTest(TestCase):
                 uut.open()  # 2nd time, not idempotent (works as designed)
         uut.close()  # 2nd time, idempotent
 
+    def test_compact(self):
+        """Tests compacting a recording leaves it playable."""
+        with TapeDeck(self.datadir / "recording", Mode.Recording) as uut:
+            uut.record(self.context1, ["dean"] * 1000, None)
+            uut.record(self.context2, None, NotImplementedError("unit test error"))
+            uut.compact()
+            self.context1.meta.pop(TapeDeck.LABEL_TAPE)
+            self.context2.meta.pop(TapeDeck.LABEL_TAPE)
+
+        with TapeDeck(self.datadir / "recording", Mode.Playback) as uut:
+            uut.compact()  # read-only, does nothing
+            self.assertEqual(uut.playback(self.context1), ["dean"] * 1000)
+            with self.assertRaises(NotImplementedError):
+                uut.playback(self.context2)
+
+        with self.assertRaises(TapeDeckOpenError):
+            uut.compact()  # not open!
+
+    def test_dump(self):
+        """Tests dump lists each channel's calls in ordinal order."""
+        with TapeDeck(self.datadir / "recording", Mode.Recording) as uut:
+            for result in range(5):
+                uut.record(self.context1, result, None)
+                self.context1.meta.pop(TapeDeck.LABEL_TAPE)
+            uut.record(self.context2, None, ValueError("nope"), channel="other")
+            uut.dump(self.datadir / "dump.yaml")
+
+        with (self.datadir / "dump.yaml").open() as fin:
+            dumped = yaml.load(fin, Loader=yaml.UnsafeLoader)  # nosec
+        self.assertEqual(
+            dumped[TapeDeck.LABEL_FILE_FORMAT], TapeDeck.CURRENT_FILE_FORMAT
+        )
+        self.assertEqual(
+            [payload.result for payload in dumped["default"]], list(range(5))
+        )
+        self.assertEqual(len(dumped["other"]), 1)
+        self.assertIsInstance(dumped["other"][0].ex, ValueError)
+
+    def test_dump_shared_objects(self):
+        """Tests dump output loads when channels repeat the same objects."""
+        with TapeDeck(self.datadir / "recording", Mode.Recording) as uut:
+            for channel in ("default", "other"):
+                for result in (Brother.DEAN, Brother.DEAN):
+                    uut.record(self.context1, result, None, channel=channel)
+                    self.context1.meta.pop(TapeDeck.LABEL_TAPE)
+            uut.dump(self.datadir / "dump.yaml")
+
+        with (self.datadir / "dump.yaml").open() as fin:
+            dumped = yaml.load(fin, Loader=yaml.UnsafeLoader)  # nosec
+        for channel in ("default", "other"):
+            self.assertEqual(
+                [payload.result for payload in dumped[channel]],
+                [Brother.DEAN, Brother.DEAN],
+            )
+
+    def test_dump_unpicklable_result(self):
+        """Tests dump skips a call whose result could not be recorded."""
+        with TapeDeck(self.datadir / "recording", Mode.Recording) as uut:
+            with self.assertRaises(TypeError):
+                uut.record(self.context1, threading.Lock(), None)
+            uut.record(self.context2, "dean", None)
+            uut.dump(self.datadir / "dump.yaml")
+
+        with (self.datadir / "dump.yaml").open() as fin:
+            dumped = yaml.load(fin, Loader=yaml.UnsafeLoader)  # nosec
+        self.assertEqual([payload.result for payload in dumped["default"]], ["dean"])
+
     def test_dump_closed(self):
         """Tests calling dump when not open."""
         with TapeDeck(self.datadir / "recording", Mode.Recording) as uut:
@@ -217,10 +357,20 @@ class TapeDeckTest(TestCase):
             self.assertEqual(uut.redact("foo", "THIS_IS_A_REDACTED_COUNT"), "THIS_IS_A")
             self.assertEqual(uut.redact("foo", "THIS"), "THIS_____")
 
+    def test_redact_overlapping_secrets(self):
+        """Tests a secret containing another secret is redacted as a whole."""
+        with TapeDeck(self.datadir / "recording", Mode.Recording) as uut:
+            uut.redact("hunter", "SHORT")
+            uut.redact("hunter2hunter", "LONG")
+            self.assertEqual(
+                uut._redact(("hunter2hunter", b"hunter")),
+                ("LONG_________", b"SHORT_"),
+            )
+
     def test_recording_secrets(self):
         """Tests automatic redaction of known secrets and use in playback"""
-        token = str(uuid.uuid4()).encode()
-        token2 = str(uuid.uuid4())
+        token = secrets.token_hex(16).encode()
+        token2 = secrets.token_hex(16)
         keeper = KeeperOfFineSecrets(token)
 
         # pretend someone created an object and made two calls where one succeeds and one raises